@@ -1,9 +1,24 @@
+import functools
+
+import numpy as np
 from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import Optional, Dict
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, field_validator
+from typing import Optional, Dict, List, Literal
 from datetime import date
 
-app = FastAPI(title="Capitalización de Rentas - Simplificado")
+try:
+    from numba import njit
+except ImportError:  # numba es opcional: sin él el núcleo corre en CPython
+    def njit(*args, **kwargs):
+        def decorador(func):
+            return func
+        return decorador
+
+app = FastAPI(
+    title="Capitalización de Rentas - Simplificado",
+    default_response_class=ORJSONResponse,
+)
 
 VIDA_ECONOMICA = {
     "vivienda": 100,
@@ -11,6 +26,103 @@ VIDA_ECONOMICA = {
     "local_comercial": 50,
     "industrial": 35
 }
+_get_vida = VIDA_ECONOMICA.get
+
+Tipologia = Literal["vivienda", "oficina", "local_comercial", "industrial"]
+
+
+@njit(cache=True, fastmath=True, error_model="numpy", boundscheck=False)
+def _core(flujo_neto_base, ipc_anual, tasa_actualizacion, plusvalia_anual,
+          valor_suelo, n_periodos):
+    """Núcleo numérico puro: devuelve (valor_actualizado,
+    valor_reversion_actualizado)."""
+    años_enteros = int(n_periodos)
+    fraccion = n_periodos - años_enteros
+
+    # Σ_{t=1..N} a^(t-1) · b^(t-0.5) = b^0.5 · (k^N - 1)/(k - 1), con
+    # a = 1+ipc, b = 1/(1+tasa), k = a·b (rama degenerada si k == 1).
+    a = 1.0 + ipc_anual
+    b = 1.0 / (1.0 + tasa_actualizacion)
+    k = a * b
+    if k == 1.0:
+        suma_serie = float(años_enteros)
+    else:
+        suma_serie = (k ** años_enteros - 1.0) / (k - 1.0)
+    valor_actualizado = flujo_neto_base * b ** 0.5 * suma_serie
+
+    # Factor de descuento a n_periodos, reutilizado para el flujo
+    # fraccional y la reversión (b**n = b**enteros · b**fraccion).
+    disc_enteros = b ** años_enteros
+    if fraccion > 0:
+        disc_media_fraccion = b ** (fraccion / 2.0)
+        flujo_neto_parcial = flujo_neto_base * (a ** años_enteros) * fraccion
+        valor_actualizado += flujo_neto_parcial * disc_enteros * disc_media_fraccion
+        disc_n = disc_enteros * disc_media_fraccion * disc_media_fraccion
+    else:
+        disc_n = disc_enteros
+
+    valor_reversion = valor_suelo * (1.0 + plusvalia_anual) ** n_periodos
+    valor_reversion_actualizado = valor_reversion * disc_n
+    valor_actualizado += valor_reversion_actualizado
+    return valor_actualizado, valor_reversion_actualizado
+
+
+# Warmup en el import: la primera petición no paga la compilación JIT.
+_core(1.0, 0.0, 0.1, 0.02, 1000.0, 10.5)
+
+
+@functools.lru_cache(maxsize=256)
+def _factores_descuento(ipc_q: int, tasa_q: int, años_enteros: int):
+    """Factores b^0.5 · k^(t-1) para t = 1..N, sin escalar por el flujo.
+
+    Cacheado por tasas cuantizadas a 1e-6: en barridos de cartera con
+    parámetros macro compartidos la construcción se paga una sola vez.
+    Devuelve una tupla (inmutable, segura de compartir desde la caché).
+    """
+    a = 1.0 + ipc_q / 1e6
+    b = 1.0 / (1.0 + tasa_q / 1e6)
+    k = a * b
+    factores = np.empty(años_enteros, dtype=np.float64)
+    factor_t = b ** 0.5
+    for t in range(años_enteros):
+        factores[t] = factor_t
+        factor_t *= k
+    return tuple(factores.tolist())
+
+
+def _core_batch(flujo_neto_base, ipc_anual, tasa_actualizacion,
+                plusvalia_anual, valor_suelo, n_periodos):
+    """Versión por lotes de _core sobre arrays NumPy (sin detalle de
+    flujos): una sola pasada vectorizada para toda la cartera."""
+    años_enteros = n_periodos.astype(np.int64)
+    fraccion = n_periodos - años_enteros
+
+    # Espacio logarítmico: log1p es más preciso que log(1+x) para tasas
+    # pequeñas y x**y pasa a ser un único np.exp vectorizado (SIMD).
+    log_a = np.log1p(ipc_anual)
+    log_b = -np.log1p(tasa_actualizacion)
+    log_k = log_a + log_b
+    k = np.exp(log_k)
+    degenerado = k == 1.0
+    divisor = np.where(degenerado, 1.0, k - 1.0)
+    suma_serie = np.where(
+        degenerado, años_enteros, (np.exp(años_enteros * log_k) - 1.0) / divisor
+    )
+    valor_actualizado = flujo_neto_base * np.exp(0.5 * log_b) * suma_serie
+
+    disc_enteros = np.exp(años_enteros * log_b)
+    disc_media_fraccion = np.exp(fraccion / 2.0 * log_b)
+    # fraccion == 0 anula el término parcial y deja disc_media_fraccion en 1
+    valor_actualizado += (
+        flujo_neto_base * np.exp(años_enteros * log_a) * fraccion
+        * disc_enteros * disc_media_fraccion
+    )
+    disc_n = disc_enteros * disc_media_fraccion * disc_media_fraccion
+
+    valor_reversion = valor_suelo * np.exp(n_periodos * np.log1p(plusvalia_anual))
+    valor_reversion_actualizado = valor_reversion * disc_n
+    valor_actualizado += valor_reversion_actualizado
+    return valor_actualizado, valor_reversion_actualizado
 
 class RentInput(BaseModel):
     # --- Comunes ---
@@ -29,114 +141,214 @@ class RentInput(BaseModel):
 
     # --- Sin contrato ---
     fecha_construccion: Optional[date] = None
-    tipologia: Optional[str] = None
+    tipologia: Optional[Tipologia] = None
     renta_m2_mes: Optional[float] = None
 
+    # --- Opciones de salida ---
+    include_flows: bool = False   # devolver el detalle año a año
+
+    @field_validator("tipologia", mode="before")
+    @classmethod
+    def _tipologia_en_minusculas(cls, valor):
+        # mantiene el contrato insensible a mayúsculas ("Vivienda" == "vivienda")
+        return valor.lower() if isinstance(valor, str) else valor
+
 
 class RentOutput(BaseModel):
     valor_actual: float
     valor_reversion: float
-    flujos_actualizados: Dict[str, float]
+    # posicional: índice 0 = año 1; si hay periodo fraccional, va el último
+    flujos_actualizados: List[float]
     parametros: dict
     n_periodos: float
 
 
-@app.post("/capitalizacion_rentas", response_model=RentOutput)
-def calcular_capitalizacion(data: RentInput):
+# Respuestas de error pre-construidas: dicts planos listos para orjson,
+# sin pasar por Pydantic en las ramas de error.
+_ERROR_BASE = {
+    "valor_actual": 0.0,
+    "valor_reversion": 0.0,
+    "flujos_actualizados": [],
+    "parametros": {},
+    "n_periodos": 0.0,
+}
+_ERR_MODO = {
+    **_ERROR_BASE,
+    "parametros": {"error": "Debes pasar renta_mensual (contrato) o renta_m2_mes (mercado)"},
+}
+_ERR_HORIZONTE = {
+    **_ERROR_BASE,
+    "parametros": {"error": "El horizonte de explotación es 0 o negativo"},
+}
 
-    # --- Conversión de porcentajes ---
-    porcentaje_gastos = data.porcentaje_gastos / 100
-    plusvalia_anual = data.plusvalia_anual / 100
-    tasa_actualizacion = data.tasa_actualizacion / 100
-    ipc_anual = data.ipc_anual / 100
 
-    # --- Detectar modo ---
-    if data.renta_mensual:  
-        # Con contrato
-        fecha_fin_contrato = date(
-            data.fecha_inicio_contrato.year + data.vigencia_anios,
-            data.fecha_inicio_contrato.month,
-            data.fecha_inicio_contrato.day
-        )
-        dias_restantes = (fecha_fin_contrato - data.fecha_valoracion).days
+def _horizonte_y_renta(data: RentInput):
+    """Detecta el modo (contrato/mercado) y devuelve
+    (n_periodos, renta_bruta_anual, respuesta_error)."""
+    if data.renta_mensual:
+        # Con contrato: aritmética de ordinales, sin timedelta intermedio
+        inicio = data.fecha_inicio_contrato
+        fin_ordinal = date(
+            inicio.year + data.vigencia_anios, inicio.month, inicio.day
+        ).toordinal()
+        dias_restantes = fin_ordinal - data.fecha_valoracion.toordinal()
         n_periodos = dias_restantes / 365.0
         renta_bruta_anual = data.renta_mensual * 12
 
     elif data.renta_m2_mes:
         # Sin contrato (mercado/testigos)
-        antiguedad = (data.fecha_valoracion.year - data.fecha_construccion.year) - (
-            (data.fecha_valoracion.month, data.fecha_valoracion.day) <
-            (data.fecha_construccion.month, data.fecha_construccion.day)
+        val = data.fecha_valoracion
+        con = data.fecha_construccion
+        antiguedad = (val.year - con.year) - (
+            (val.month, val.day) < (con.month, con.day)
         )
-        vida_economica = VIDA_ECONOMICA.get(data.tipologia.lower())
+        # tipologia llega ya normalizada y validada por el modelo
+        vida_economica = _get_vida(data.tipologia)
         if not vida_economica:
-            return RentOutput(
-                valor_actual=0,
-                valor_reversion=0,
-                flujos_actualizados={},
-                parametros={"error": f"Tipología no reconocida: {data.tipologia}"},
-                n_periodos=0
-            )
+            return 0.0, 0.0, {
+                **_ERROR_BASE,
+                "parametros": {"error": f"Tipología no reconocida: {data.tipologia}"},
+            }
         n_periodos = vida_economica - antiguedad
         renta_bruta_anual = data.renta_m2_mes * data.superficie_m2 * 12
 
     else:
-        return RentOutput(
-            valor_actual=0,
-            valor_reversion=0,
-            flujos_actualizados={},
-            parametros={"error": "Debes pasar renta_mensual (contrato) o renta_m2_mes (mercado)"},
-            n_periodos=0
-        )
+        return 0.0, 0.0, _ERR_MODO
 
     if n_periodos <= 0:
-        return RentOutput(
-            valor_actual=0,
-            valor_reversion=0,
-            flujos_actualizados={},
-            parametros={"error": "El horizonte de explotación es 0 o negativo"},
-            n_periodos=0
-        )
+        return 0.0, 0.0, _ERR_HORIZONTE
 
-    # --- Gastos y flujo neto ---
-    gastos_anuales = renta_bruta_anual * porcentaje_gastos
-    flujo_neto_base = renta_bruta_anual - gastos_anuales
+    return n_periodos, renta_bruta_anual, None
 
-    # --- Valor de reversión ---
-    valor_reversion = data.valor_suelo * ((1 + plusvalia_anual) ** n_periodos)
 
-    # --- Flujos actualizados ---
-    flujos_actualizados: Dict[str, float] = {}
-    valor_actualizado = 0.0
-    años_enteros = int(n_periodos)
-    fraccion = n_periodos - años_enteros
+@app.post(
+    "/capitalizacion_rentas",
+    response_model=None,
+    responses={200: {"model": RentOutput}},
+)
+def calcular_capitalizacion(data: RentInput):
+    """Valora un inmueble por capitalización de rentas.
 
-    for t in range(1, años_enteros + 1):
-        flujo_neto = flujo_neto_base * ((1 + ipc_anual) ** (t - 1))
-        tiempo = (t - 0.5)
-        valor_flujo = flujo_neto / ((1 + tasa_actualizacion) ** tiempo)
-        flujos_actualizados[str(t)] = round(valor_flujo, 2)
-        valor_actualizado += valor_flujo
+    El detalle año a año (`flujos_actualizados`) solo se calcula y se
+    serializa si la petición manda `include_flows: true`; por defecto la
+    respuesta lleva únicamente los escalares.
+    """
+    # --- Conversión de porcentajes ---
+    porcentaje_gastos = data.porcentaje_gastos / 100
+    plusvalia_anual = data.plusvalia_anual / 100
+    tasa_actualizacion = data.tasa_actualizacion / 100
+    ipc_anual = data.ipc_anual / 100
 
-    if fraccion > 0:
-        flujo_neto_parcial = flujo_neto_base * ((1 + ipc_anual) ** años_enteros) * fraccion
-        tiempo = años_enteros + fraccion / 2
-        valor_flujo = flujo_neto_parcial / ((1 + tasa_actualizacion) ** tiempo)
-        flujos_actualizados[f"{años_enteros + fraccion:.2f}"] = round(valor_flujo, 2)
-        valor_actualizado += valor_flujo
+    # --- Detectar modo ---
+    n_periodos, renta_bruta_anual, respuesta_error = _horizonte_y_renta(data)
+    if respuesta_error is not None:
+        return respuesta_error
 
-    valor_reversion_actualizado = valor_reversion / ((1 + tasa_actualizacion) ** n_periodos)
-    valor_actualizado += valor_reversion_actualizado
+    # --- Gastos y flujo neto ---
+    gastos_anuales = renta_bruta_anual * porcentaje_gastos
+    flujo_neto_base = renta_bruta_anual - gastos_anuales
+
+    # --- Núcleo numérico ---
+    valor_actualizado, valor_reversion_actualizado = _core(
+        flujo_neto_base, ipc_anual, tasa_actualizacion, plusvalia_anual,
+        data.valor_suelo, float(n_periodos)
+    )
+
+    # El detalle año a año escala los factores cacheados; el redondeo
+    # queda en la frontera HTTP y la lista va directa a la respuesta
+    flujos_actualizados: List[float] = []
+    if data.include_flows:
+        años_enteros = int(n_periodos)
+        fraccion = n_periodos - años_enteros
+        factores = _factores_descuento(
+            int(round(ipc_anual * 1e6)),
+            int(round(tasa_actualizacion * 1e6)),
+            años_enteros,
+        )
+        flujos_actualizados = np.round(
+            np.asarray(factores) * flujo_neto_base, 2
+        ).tolist()
+        if fraccion > 0:
+            a = 1.0 + ipc_anual
+            b = 1.0 / (1.0 + tasa_actualizacion)
+            valor_flujo = (
+                flujo_neto_base * (a ** años_enteros) * fraccion
+                * b ** años_enteros * b ** (fraccion / 2.0)
+            )
+            flujos_actualizados.append(round(valor_flujo, 2))
 
-    return RentOutput(
-        valor_actual=round(valor_actualizado, 2),
-        valor_reversion=round(valor_reversion_actualizado, 2),
-        flujos_actualizados=flujos_actualizados,
-        parametros={
+    # dict plano: orjson lo serializa directamente, sin vuelta por Pydantic
+    return {
+        "valor_actual": round(valor_actualizado, 2),
+        "valor_reversion": round(valor_reversion_actualizado, 2),
+        "flujos_actualizados": flujos_actualizados,
+        "parametros": {
             "renta_bruta_anual": renta_bruta_anual,
             "gastos_anuales": gastos_anuales,
             "flujo_neto_base": flujo_neto_base,
             "valor_suelo": data.valor_suelo
         },
-        n_periodos=round(n_periodos, 2)
-    )
+        "n_periodos": round(float(n_periodos), 2)
+    }
+
+
+class RentBatchInput(BaseModel):
+    inmuebles: List[RentInput]
+
+
+class RentBatchOutput(BaseModel):
+    valores_actuales: List[float]
+    valores_reversion: List[float]
+    n_periodos: List[float]
+    errores: Dict[str, str]   # índice del inmueble -> mensaje
+
+
+@app.post(
+    "/capitalizacion_rentas/batch",
+    response_model=None,
+    responses={200: {"model": RentBatchOutput}},
+)
+def calcular_capitalizacion_batch(data: RentBatchInput):
+    """Valora una cartera completa en una sola pasada vectorizada.
+
+    Los inmuebles con error quedan a 0 en los arrays y su mensaje se
+    recoge en `errores`; el resto se calcula con _core_batch.
+    """
+    n = len(data.inmuebles)
+    flujo_neto_base = np.zeros(n)
+    ipc = np.zeros(n)
+    tasa = np.zeros(n)
+    plusvalia = np.zeros(n)
+    suelo = np.zeros(n)
+    periodos = np.zeros(n)
+    errores: Dict[str, str] = {}
+
+    for i, inmueble in enumerate(data.inmuebles):
+        n_periodos, renta_bruta_anual, respuesta_error = _horizonte_y_renta(inmueble)
+        if respuesta_error is not None:
+            errores[str(i)] = respuesta_error["parametros"]["error"]
+            continue
+        flujo_neto_base[i] = renta_bruta_anual * (1 - inmueble.porcentaje_gastos / 100)
+        ipc[i] = inmueble.ipc_anual / 100
+        tasa[i] = inmueble.tasa_actualizacion / 100
+        plusvalia[i] = inmueble.plusvalia_anual / 100
+        suelo[i] = inmueble.valor_suelo
+        periodos[i] = n_periodos
+
+    validos = periodos > 0
+    valores_actuales = np.zeros(n)
+    valores_reversion = np.zeros(n)
+    if validos.any():
+        va, vr = _core_batch(
+            flujo_neto_base[validos], ipc[validos], tasa[validos],
+            plusvalia[validos], suelo[validos], periodos[validos]
+        )
+        valores_actuales[validos] = va
+        valores_reversion[validos] = vr
+
+    return {
+        "valores_actuales": np.round(valores_actuales, 2).tolist(),
+        "valores_reversion": np.round(valores_reversion, 2).tolist(),
+        "n_periodos": np.round(periodos, 2).tolist(),
+        "errores": errores,
+    }